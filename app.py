@@ -1,28 +1,55 @@
 import streamlit as st
-import requests
+import os
 import uuid
 import time
-import bcrypt
+import hashlib
+import secrets
+import threading
+import queue
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, Future
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+import tiktoken
 from dotenv import dotenv_values
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http.models import (
+    Direction,
+    Filter,
+    FieldCondition,
+    MatchValue,
+    OrderBy,
+    PayloadSchemaType,
+    PointStruct,
+    VectorParams,
+)
 from openai import OpenAI
-import openai
 
 # -------------------------  KONFIGURACJA  -------------------------
 
-env = dotenv_values(".env")
+@st.cache_resource
+def get_env():
+    """
+    Wczytuje konfigurację z pliku .env (raz na proces, a nie przy każdym przeładowaniu strony).
+    Zwraca słownik tylko do odczytu – współdzielony przez wszystkie sesje.
+    """
+    env = dict(dotenv_values(".env"))
 
-# Nadpisujemy wartości zmiennych ze st.secrets, jeśli są dostępne
-if "QDRANT_URL" in st.secrets:
-    env["QDRANT_URL"] = st.secrets["QDRANT_URL"]
-if "QDRANT_API_KEY" in st.secrets:
-    env["QDRANT_API_KEY"] = st.secrets["QDRANT_API_KEY"]
-if "OPENAI_API_KEY" in st.secrets:
-    env["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
+    # Nadpisujemy wartości zmiennych ze st.secrets, jeśli są dostępne
+    for key in ("QDRANT_URL", "QDRANT_API_KEY", "OPENAI_API_KEY"):
+        if key in st.secrets:
+            env[key] = st.secrets[key]
+    return MappingProxyType(env)
 
-# Teraz możesz bezpiecznie zainicjować klienta OpenAI
-openai_client = OpenAI(api_key=env["OPENAI_API_KEY"])
+@st.cache_resource
+def get_openai_client():
+    """
+    Zwraca zcache'owaną instancję klienta OpenAI.
+    """
+    # Klient jest współdzielony przez cały proces, więc domyślna pula połączeń keep-alive SDK
+    # jest używana ponownie – kolejne zapytania nie powtarzają handshake'u TLS
+    return OpenAI(api_key=get_env()["OPENAI_API_KEY"])
 
 @st.cache_resource
 def get_qdrant_client():
@@ -30,279 +57,565 @@ def get_qdrant_client():
     Zwraca zcache'owaną instancję klienta Qdrant.
     """
     return QdrantClient(
-        url=env["QDRANT_URL"],     # np. "https://xxx-xxxxx-xxx-xxxxx.aws.cloud.qdrant.io"
-        api_key=env["QDRANT_API_KEY"],
+        url=get_env()["QDRANT_URL"],     # np. "https://xxx-xxxxx-xxx-xxxxx.aws.cloud.qdrant.io"
+        api_key=get_env()["QDRANT_API_KEY"],
+        # gRPC (port 6334) ma mniejszy narzut na zapytanie niż REST; można wyłączyć przez QDRANT_PREFER_GRPC=false
+        prefer_grpc=(get_env().get("QDRANT_PREFER_GRPC") or "true").lower() == "true",
+        grpc_port=6334,
+        # Większa pula połączeń niż domyślne 3 – równoległe sesje nie czekają na wolne połączenie
+        pool_size=20,
+        timeout=10,
     )
 
 
-# -------------------------  FUNKCJE: UŻYTKOWNICY  -------------------------
+def get_collection_names(client):
+    """
+    Zwraca zbiór nazw kolekcji w Qdrant. Lista jest pobierana raz na sesję i trzymana
+    w st.session_state; nowo utworzone kolekcje są do niej dopisywane bez ponownego pobierania.
+    """
+    if st.session_state.get("_collection_names") is None:
+        st.session_state["_collection_names"] = {col.name for col in client.get_collections().collections}
+    return st.session_state["_collection_names"]
 
-def create_users_collection():
+def collection_exists(client, collection_name):
     """
-    Tworzy (jeśli nie istnieje) kolekcję 'users' do przechowywania danych o użytkownikach.
+    Sprawdza, czy kolekcja istnieje. Brak w zbiorze z sesji jest potwierdzany w Qdrant –
+    kolekcję mogła w międzyczasie utworzyć inna sesja.
     """
-    client = get_qdrant_client()
-    existing = client.get_collections().collections
-    names = [col.name for col in existing]
-    if "users" not in names:
+    collection_names = get_collection_names(client)
+    if collection_name in collection_names:
+        return True
+    if client.collection_exists(collection_name):
+        collection_names.add(collection_name)
+        return True
+    return False
+
+def create_collection(client, collection_name):
+    """
+    Tworzy kolekcję bez wektorów i dopisuje ją do zbioru nazw. Jeśli w międzyczasie utworzyła ją
+    inna sesja, błąd Qdrant jest ignorowany – pozostałe błędy są przekazywane dalej.
+    """
+    try:
         client.create_collection(
-            collection_name="users",
-            vectors_config=VectorParams(size=1, distance=Distance.COSINE)
+            collection_name=collection_name,
+            vectors_config={},  # bez wektorów – dane są wyszukiwane wyłącznie po payloadzie
+            on_disk_payload=True
         )
+    except Exception:
+        if not client.collection_exists(collection_name):
+            raise
+    get_collection_names(client).add(collection_name)
+
+
+@st.cache_data(show_spinner=False)
+def point_vector(_client, collection_name):
+    """
+    Zwraca wektor, z jakim należy zapisywać punkty w danej kolekcji: pusty ({}) dla kolekcji
+    bez wektorów, a [0.0] dla starszych kolekcji założonych z wektorem o rozmiarze 1,
+    które bez niego odrzucają zapis.
+    """
+    vectors = _client.get_collection(collection_name).config.params.vectors
+    return [0.0] if isinstance(vectors, VectorParams) else {}
+
+
+class UpsertBatcher:
+    """
+    Zbiera zapisy (upsert) ze wszystkich sesji i wysyła je do Qdrant zbiorczo: jedno zapytanie
+    na kolekcję, gdy uzbiera się MAX_BATCH punktów albo minie MAX_DELAY sekund od pierwszego.
+    Każdy zapis dostaje Future, więc wywołujący może poczekać na wynik lub obsłużyć błąd.
+    """
+    MAX_BATCH = 32
+    MAX_DELAY = 0.05
+
+    def __init__(self, client):
+        self._client = client
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, collection_name, points, wait=False):
+        future = Future()
+        self._queue.put((collection_name, points, wait, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][1])
+            deadline = time.monotonic() + self.MAX_DELAY
+            while size < self.MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[1])
+            self._send(batch)
+
+    def _send(self, batch):
+        groups = {}
+        for collection_name, points, wait, future in batch:
+            group = groups.setdefault((collection_name, wait), ([], []))
+            group[0].extend(points)
+            group[1].append(future)
+        for (collection_name, wait), (points, futures) in groups.items():
+            try:
+                self._client.upsert(collection_name=collection_name, points=points, wait=wait)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(None)
+
+@st.cache_resource
+def get_upsert_batcher(_client):
+    """
+    Zwraca współdzielony (na cały proces) UpsertBatcher dla danego klienta Qdrant.
+    """
+    return UpsertBatcher(_client)
+
+
+# -------------------------  FUNKCJE: UŻYTKOWNICY  -------------------------
+
+def create_users_collection(client):
+    """
+    Tworzy (jeśli nie istnieje) kolekcję 'users' do przechowywania danych o użytkownikach.
+    """
+    if not collection_exists(client, "users"):
+        create_collection(client, "users")
+    # Indeks pozwala wyszukiwać użytkownika filtrem zamiast skanować kolekcję
+    ensure_payload_index(client, "users", "username", PayloadSchemaType.KEYWORD)
+
+@st.cache_resource
+def ensure_payload_index(_client, collection_name, field_name, field_schema):
+    """
+    Zakłada (raz na proces) indeks na polu payloadu – także w kolekcji utworzonej wcześniej bez niego.
+    Błędy (sieć, autoryzacja) nie są wyciszane – cache_resource ich nie zapamiętuje,
+    więc próba zostanie ponowiona przy kolejnym uruchomieniu.
+    """
+    if field_name in (_client.get_collection(collection_name).payload_schema or {}):
+        return
+    _client.create_payload_index(
+        collection_name=collection_name,
+        field_name=field_name,
+        field_schema=field_schema
+    )
+
+@st.cache_resource
+def get_password_hasher():
+    """
+    Zwraca zcache'owany hasher argon2id (parametry wg rekomendacji OWASP: 19 MiB pamięci, 2 iteracje).
+    """
+    return PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+@st.cache_resource
+def get_password_executor():
+    """
+    Zwraca współdzieloną pulę wątków do obliczeń skrótów haseł (rozmiar = liczba rdzeni).
+    argon2 i bcrypt zwalniają GIL, więc równoległe logowania liczą się na osobnych rdzeniach,
+    a pula ogranicza ich liczbę, żeby nie zagłodzić wątków renderujących strony.
+    """
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 2)
 
 def hash_password(password: str) -> str:
     """
-    Hashuje hasło przy użyciu bcrypt.
-    Zwraca zakodowany hash w formie str.
+    Hashuje hasło przy użyciu argon2id.
+    Zwraca hash w formie str (algorytm i parametry są zapisane w jego prefiksie, np. $argon2id$v=19$m=19456,t=2,p=1$...).
     """
-    hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-    return hashed.decode("utf-8")
+    return get_password_executor().submit(get_password_hasher().hash, password).result()
+
+def needs_rehash(hashed: str) -> bool:
+    """
+    Sprawdza, czy hash trzeba przeliczyć: starsze hashe bcrypt ('$2b$...') oraz hashe argon2
+    z innymi parametrami niż obecnie skonfigurowane.
+    """
+    if not hashed.startswith("$argon2"):
+        return True
+    return get_password_hasher().check_needs_rehash(hashed)
+
+def verify_hash(password: str, hashed: str) -> bool:
+    """
+    Weryfikuje hasło algorytmem zapisanym w prefiksie hasha: argon2 lub (dla starszych kont) bcrypt.
+    """
+    if hashed.startswith("$argon2"):
+        try:
+            return get_password_hasher().verify(hashed, password)
+        except (VerifyMismatchError, InvalidHashError):
+            return False
+    import bcrypt  # potrzebny tylko dla kont z hasłem zapisanym przed przejściem na argon2
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+VERIFY_CACHE_SIZE = 512
+
+@st.cache_resource
+def get_verify_cache():
+    """
+    Zwraca współdzielony (na cały proces) cache wyników weryfikacji haseł wraz z blokadą.
+    Kluczem jest para (SHA-256 hasła, zapisany hash) – samo hasło nigdy nie jest przechowywane.
+    """
+    return OrderedDict(), threading.Lock()
 
 def check_password(password: str, hashed: str) -> bool:
     """
     Sprawdza, czy hasło 'password' pasuje do zapisanego hasha 'hashed'.
+    Wynik jest zapamiętywany w ograniczonym cache LRU, więc powtórna weryfikacja
+    tych samych danych nie uruchamia ponownie kosztownego skrótu.
     """
-    return bcrypt.hashpw(password.encode("utf-8"), hashed.encode("utf-8")) == hashed.encode("utf-8")
+    cache, lock = get_verify_cache()
+    key = (hashlib.sha256(password.encode("utf-8")).digest(), hashed.encode("utf-8"))
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    result = get_password_executor().submit(verify_hash, password, hashed).result()
+    with lock:
+        cache[key] = result
+        if len(cache) > VERIFY_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
 
-def register_user(username: str, password: str, email: str) -> bool:
+@st.cache_resource
+def check_password_roundtrip():
+    """
+    Test poprawności (raz na proces, tylko przy DEBUG w konfiguracji): hash świeżo
+    utworzony przez hash_password musi przejść weryfikację, a inne hasło – nie.
+    """
+    # Jawne wyjątki zamiast assert – asercje są pomijane przy uruchomieniu z python -O
+    hashed = hash_password("x")
+    if not check_password("x", hashed):
+        raise RuntimeError("check_password odrzuca poprawne hasło")
+    if check_password("y", hashed):
+        raise RuntimeError("check_password akceptuje błędne hasło")
+
+def register_user(client, username: str, password: str, email: str) -> bool:
     """
     Rejestruje nowego użytkownika w kolekcji 'users'.
     Zwraca True, jeśli rejestracja się udała, lub False, jeśli użytkownik już istnieje.
+    Sprawdzenie i zapis nie są atomowe: dwie równoczesne rejestracje tej samej nazwy
+    (okno poszerza zbieranie zapisów przez UpsertBatcher, do 50 ms) mogą obie przejść
+    sprawdzenie, a późniejszy upsert nadpisze konto utworzone przez pierwszą.
     """
-    client = get_qdrant_client()
-    if find_user(username):
+    user_id = user_point_id(username)
+    # Sprawdzamy samo id – nazwy różniące się wielkością liter mają ten sam identyfikator;
+    # konta z losowym id (sprzed UUID5) wyszukujemy już tylko filtrem po nazwie
+    if (client.retrieve(collection_name="users", ids=[user_id], with_payload=False, with_vectors=False)
+            or find_legacy_user_record(client, username)):
         return False  # użytkownik już istnieje
 
-    user_id = str(uuid.uuid4())
     payload = {
         "username": username,
         "hashed_password": hash_password(password),
         "email": email,
         "created_at": int(time.time())
     }
-    client.upsert(
-        collection_name="users",
-        points=[{
-            "id": user_id,
-            "vector": [0.0],  # Dummy wektor
-            "payload": payload
-        }]
-    )
+    # wait=True i czekamy na wynik – zaraz po rejestracji użytkownik może się logować
+    get_upsert_batcher(client).submit(
+        "users",
+        [PointStruct(id=user_id, vector=point_vector(client, "users"), payload=payload)],
+        wait=True
+    ).result()
+    find_user_record.clear()
     return True
 
-def find_user(username: str):
-    client = get_qdrant_client()
-
-    all_points = []
-    next_offset = None
-
-    while True:
-        points, next_offset = client.scroll(
-            collection_name="users",
-            limit=50,
-            offset=next_offset
-        )
-        all_points.extend(points)
-
-        # Jeśli next_offset jest None, nie ma kolejnych "stron"
-        if next_offset is None:
-            break
+def user_point_id(username: str) -> str:
+    """
+    Deterministyczny identyfikator punktu użytkownika wyliczany z nazwy (UUID5),
+    dzięki któremu rekord można pobrać bezpośrednio przez retrieve().
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, username.strip().lower()))
 
-    for point in all_points:
-        payload = point.payload
-        if payload.get("username") == username:
-            return payload
-    return None
+def find_user(client, username: str):
+    """
+    Zwraca payload użytkownika o danej nazwie lub None, jeśli nie istnieje.
+    """
+    user_record = find_user_record(client, username)
+    return user_record.payload if user_record else None
 
 # Dodane funkcje do resetu hasła:
 
-def find_user_record(username: str):
+@st.cache_data(ttl=5, show_spinner=False)
+def find_user_record(_client, username: str):
     """
     Zwraca CAŁY rekord (point) użytkownika o danej nazwie (z polami .id i .payload).
     Jeśli nie znajdzie, zwraca None.
+    Rekord jest pobierany bezpośrednio po id (UUID5 z nazwy); konta założone wcześniej
+    z losowym id są wyszukiwane filtrem po zaindeksowanym polu 'username'.
+    Wynik jest cache'owany przez 5 s (np. rejestracja i zaraz potem logowanie);
+    funkcje zapisujące użytkownika czyszczą cache.
     """
-    client = get_qdrant_client()
-    all_points = []
-    next_offset = None
-    while True:
-        points, next_offset = client.scroll(
-            collection_name="users",
-            limit=50,
-            offset=next_offset
-        )
-        all_points.extend(points)
-        if next_offset is None:
-            break
-    for point in all_points:
-        if point.payload.get("username") == username:
-            return point
-    return None
+    points = _client.retrieve(
+        collection_name="users",
+        ids=[user_point_id(username)],
+        with_payload=True,
+        with_vectors=False
+    )
+    if points and points[0].payload.get("username") == username:
+        return points[0]
+    return find_legacy_user_record(_client, username)
+
+def find_legacy_user_record(client, username: str):
+    """
+    Wyszukuje rekord użytkownika filtrem po zaindeksowanym polu 'username' – dla kont
+    założonych wcześniej z losowym id. Zwraca point lub None.
+    """
+    points, _ = client.scroll(
+        collection_name="users",
+        scroll_filter=Filter(must=[
+            FieldCondition(key="username", match=MatchValue(value=username))
+        ]),
+        limit=1,
+        with_payload=True,
+        with_vectors=False
+    )
+    return points[0] if points else None
 
-def reset_password(username: str, email: str, new_password: str) -> bool:
+def reset_password(client, username: str, email: str, new_password: str) -> bool:
     """
     Resetuje hasło użytkownika, jeśli podany adres e-mail zgadza się z tym zapisanym w bazie.
     Aktualizuje zahashowane hasło w Qdrant i zwraca True, jeśli operacja się powiodła.
     """
-    client = get_qdrant_client()
-    user_record = find_user_record(username)
+    user_record = find_user_record(client, username)
     if not user_record:
         return False
     if user_record.payload.get("email") != email:
         return False
 
-    new_hashed = hash_password(new_password)
-    updated_payload = user_record.payload.copy()
-    updated_payload["hashed_password"] = new_hashed
-
-    client.upsert(
-         collection_name="users",
-         points=[{
-              "id": user_record.id,
-              "vector": [0.0],
-              "payload": updated_payload
-         }]
+    # Częściowa aktualizacja – nadpisujemy tylko pole z hashem, bez przesyłania całego punktu
+    client.set_payload(
+        collection_name="users",
+        payload={"hashed_password": hash_password(new_password)},
+        points=[user_record.id]
     )
+    find_user_record.clear()
     return True
 
-def login_user(username: str, password: str) -> bool:
+def login_user(client, username: str, password: str) -> bool:
     """
     Loguje użytkownika. Zwraca True, jeśli dane poprawne, False w przeciwnym wypadku.
     """
-    user = find_user(username)
+    user = find_user(client, username)
     if not user:
         return False
     hashed = user["hashed_password"]
-    return check_password(password, hashed)
+    if not check_password(password, hashed):
+        return False
+
+    # Migracja: hashe bcrypt lub argon2 ze starymi parametrami przeliczamy przy udanym logowaniu
+    if needs_rehash(hashed):
+        rehash_password(client, username, password)
+    return True
+
+def rehash_password(client, username: str, password: str):
+    """
+    Zapisuje nowy hash hasła (argon2 z aktualnymi parametrami) dla istniejącego użytkownika.
+    """
+    user_record = find_user_record(client, username)
+    if not user_record:
+        return
+    client.set_payload(
+        collection_name="users",
+        payload={"hashed_password": hash_password(password)},
+        points=[user_record.id]
+    )
+    find_user_record.clear()
 
-def create_user_collection_if_not_exists(username: str):
+def create_user_collection_if_not_exists(client, username: str):
     """
     Dla zalogowanego użytkownika tworzy kolekcję w Qdrant,
     w której będą przechowywane jego historie.
     """
-    client = get_qdrant_client()
-    existing = client.get_collections().collections
-    collection_names = [col.name for col in existing]
-    if username not in collection_names:
-        client.create_collection(
-            collection_name=username,
-            vectors_config=VectorParams(size=1, distance=Distance.COSINE)
-        )
+    if not collection_exists(client, username):
+        create_collection(client, username)
+    # Indeks na znaczniku czasu – historia jest z niego sortowana (order_by w get_history)
+    ensure_payload_index(client, username, "timestamp", PayloadSchemaType.INTEGER)
+    # Kolekcja na pewno istnieje – zakładka z historią nie musi już tego sprawdzać
+    st.session_state["user_collection_ready"] = True
 
 # -------------------------  FUNKCJE: GENERATOR HISTORII  -------------------------
 
-def save_history(account_name, record_type, prompt_text, generated_text, cost_usd, cost_pln):
+def save_history(client, account_name, record_type, prompt_text, generated_text,
+                 prompt_tokens, output_tokens, cost_usd, cost_pln):
     """
-    Zapisuje rekord (historię) do kolekcji odpowiadającej kontu w Qdrant.
+    Dodaje rekord (historię) do bufora zapisów dla konta; bufor jest wysyłany do Qdrant
+    przez flush_history() na końcu każdego przebiegu skryptu.
+    Nie czeka na zapis – ewentualne błędy zgłasza później report_failed_writes().
     """
-    client = get_qdrant_client()
     record_id = str(uuid.uuid4())
-    vector = [0.0]
     payload = {
         "type": record_type,
         "prompt": prompt_text,
         "generated_text": generated_text,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": output_tokens,
         "cost_usd": cost_usd,
         "cost_pln": cost_pln,
         "timestamp": int(time.time())
     }
-    client.upsert(
-        collection_name=account_name,
-        points=[{
-            "id": record_id,
-            "vector": vector,
-            "payload": payload
-        }]
-    )
-    st.success(f"Twoja opowieść została pomyślnie zapisana na Twoim koncie!")
+    point = PointStruct(id=record_id, vector=point_vector(client, account_name), payload=payload)
+    pending = st.session_state.setdefault("_pending_writes", {})
+    pending.setdefault(account_name, []).append(point)
+    # Historia jest posortowana od najnowszych, więc rekord trafia na początek wczytanej listy
+    # i jest widoczny od razu – jeszcze zanim zapis dotrze do Qdrant
+    history = st.session_state.get(f"history_{account_name}")
+    if history is not None:
+        history["points"].insert(0, point)
+
+def flush_history(client):
+    """
+    Przekazuje zbuforowane rekordy historii do UpsertBatcher, który wysyła je w tle
+    (razem z zapisami innych sesji do tej samej kolekcji), więc nie blokuje renderowania strony;
+    wait=False: Qdrant odpowiada od razu, bez czekania na zapis na dysk.
+    Wywoływana raz, na końcu main() – przebieg przerwany przez st.rerun() zostawia bufor
+    w sesji i zostanie on wysłany w następnym przebiegu.
+    """
+    pending = st.session_state.get("_pending_writes")
+    if not pending:
+        return
+    batcher = get_upsert_batcher(client)
+    versions, lock = get_history_versions()
+    futures = st.session_state.setdefault("_write_futures", [])
+    for account_name, points in pending.items():
+        future = batcher.submit(account_name, points)
+        future.add_done_callback(lambda f, name=account_name: bump_history_version(f, versions, lock, name))
+        futures.append((future, account_name, points))
+    st.session_state["_pending_writes"] = {}
 
-def get_history(account_name):
-    client = get_qdrant_client()
-    all_points = []
-    next_offset = None
-
-    while True:
-        points, next_offset = client.scroll(
-            collection_name=account_name,
-            limit=50,
-            offset=next_offset
-        )
-        all_points.extend(points)
+@st.cache_resource
+def get_history_versions():
+    """
+    Zwraca współdzielone (na cały proces) numery wersji historii poszczególnych kont wraz z blokadą.
+    Numer rośnie po każdym udanym zapisie, więc sesja, która wczytała historię wcześniej
+    (także w innej karcie), wie, że musi pobrać ją ponownie.
+    """
+    return {}, threading.Lock()
 
-        if next_offset is None:
-            break
+def bump_history_version(future, versions, lock, account_name):
+    """
+    Po udanym zapisie zwiększa numer wersji historii konta. Wywoływana z wątku UpsertBatcher,
+    dlatego słownik i blokada są przekazywane jawnie, a nie pobierane z cache Streamlit.
+    """
+    if future.exception() is not None:
+        return
+    with lock:
+        versions[account_name] = versions.get(account_name, 0) + 1
 
-    return all_points
+def report_failed_writes():
+    """
+    Sprawdza zakończone zapisy wysłane w tle. Nieudane zgłasza użytkownikowi i odkłada
+    z powrotem do bufora, żeby zostały ponowione przy następnym flush_history().
+    """
+    still_running = []
+    for future, account_name, points in st.session_state.get("_write_futures", []):
+        if not future.done():
+            still_running.append((future, account_name, points))
+        elif future.exception() is not None:
+            st.error(f"Nie udało się zapisać historii: {future.exception()}. Spróbujemy ponownie.")
+            pending = st.session_state.setdefault("_pending_writes", {})
+            pending.setdefault(account_name, []).extend(points)
+    st.session_state["_write_futures"] = still_running
+
+HISTORY_PAGE_SIZE = 200
+
+def get_history(client, account_name, limit=HISTORY_PAGE_SIZE, start_from=None):
+    """
+    Pobiera jedną stronę historii użytkownika, od najnowszych rekordów (sortowanie po
+    zaindeksowanym polu 'timestamp'). Zwraca krotkę (points, next_start); next_start to
+    znacznik czasu, od którego zaczyna się kolejna strona, lub None, gdy nie ma kolejnych stron.
+    Kolejna strona zaczyna się od tego samego znacznika (włącznie), więc rekordy z granicy
+    stron powtarzają się – wywołujący pomija je po id.
+    """
+    points, _ = client.scroll(
+        collection_name=account_name,
+        limit=limit,
+        order_by=OrderBy(key="timestamp", direction=Direction.DESC, start_from=start_from),
+        with_payload=True,
+        with_vectors=False
+    )
+    next_start = points[-1].payload["timestamp"] if len(points) == limit else None
+    return points, next_start
+
+PROMPT_TEMPLATES = {
+    "Ulubione Universum": ("Stwórz mi z tego problemu szczegółowe opowiadanie dla osoby, która go nie rozumie, aby mu wytłumaczyć."
+                           "{style}\nProblem: {problem}"),
+    "Zabawnie": ("Stwórz mi z tego problemu długi, kilkupoziomowy żart, ale taki śmieszny jak w try not laugh, "
+                 "dla osoby, która go nie rozumie, aby mu szczegółowo i po ludzku wytłumaczyć jak, bez żadnych innych wstawek i wytłumaczeń."
+                 "\nProblem: {problem}"),
+}
+DEFAULT_PROMPT_TEMPLATE = "\nProblem: {problem}"
+STYLE_TEMPLATE = " Ale w stylu opowiadań {}."
 
 def generate_prompt(problem, mode, style=None):
     """
     Generuje prompt na podstawie wpisanego problemu oraz wybranego trybu.
     """
-    if mode == "Ulubione Universum":
-        prompt = ("Stwórz mi z tego problemu szczegółowe opowiadanie dla osoby, która go nie rozumie, aby mu wytłumaczyć.")
-        if style:
-            prompt += f" Ale w stylu opowiadań {style}."
-    elif mode == "Zabawnie":
-        prompt = ("Stwórz mi z tego problemu długi, kilkupoziomowy żart, ale taki śmieszny jak w try not laugh, "
-                  "dla osoby, która go nie rozumie, aby mu szczegółowo i po ludzku wytłumaczyć jak, bez żadnych innych wstawek i wytłumaczeń.")
-    else:
-        prompt = ""
-    prompt += "\nProblem: " + problem
-    return prompt
+    template = PROMPT_TEMPLATES.get(mode, DEFAULT_PROMPT_TEMPLATE)
+    style_part = STYLE_TEMPLATE.format(style) if style else ""
+    return template.format(style=style_part, problem=problem)
+
+def get_gpt4_response(openai_client, prompt):
+    """
+    Wywołuje API GPT-4 (lub inny model) w trybie strumieniowym i zwraca strumień fragmentów odpowiedzi.
+    Ostatni fragment strumienia zawiera zużycie tokenów ('usage').
+    Błędy API są przekazywane dalej.
+    """
+    return openai_client.chat.completions.create(
+        model="gpt-4o",  # Zmień na "gpt-4" lub inny model, do którego masz dostęp
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
 
-def get_gpt4_response(prompt):
+def stream_text(stream, usage):
     """
-    Wywołuje API GPT-4 (lub inny model), aby wygenerować odpowiedź na zadany prompt.
+    Generator kolejnych fragmentów tekstu ze strumienia odpowiedzi (do użycia z st.write_stream).
+    Liczby tokenów z ostatniego fragmentu zapisuje w słowniku 'usage'.
+    """
+    for chunk in stream:
+        if chunk.usage is not None:
+            usage["prompt_tokens"] = chunk.usage.prompt_tokens
+            usage["completion_tokens"] = chunk.usage.completion_tokens
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+@st.cache_resource
+def get_token_encoder():
+    """
+    Zwraca zcache'owany tokenizer modelu gpt-4o lub None, jeśli nie udało się go wczytać
+    (tiktoken przy pierwszym użyciu pobiera pliki słownika z sieci).
     """
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",  # Zmień na "gpt-4" lub inny model, do którego masz dostęp
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        st.error(f"Błąd przy generowaniu odpowiedzi: {e}")
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
         return None
 
 def approximate_token_count(text):
     """
-    Prosta aproksymacja liczby tokenów: średnio 4 znaki = 1 token.
+    Liczba tokenów tekstu według tokenizera gpt-4o (bez narzutu formatu wiadomości czatu).
+    Gdy tokenizer jest niedostępny: prosta aproksymacja, średnio 4 znaki = 1 token.
     """
-    return max(1, len(text) // 4)
+    encoder = get_token_encoder()
+    if encoder is None:
+        return max(1, len(text) // 4)
+    return max(1, len(encoder.encode(text)))
+
+PROMPT_PRICE_USD_PER_MTOK = 2.5
+OUTPUT_PRICE_USD_PER_MTOK = 10.0
 
-def calculate_cost(prompt_text, generated_text, exchange_rate=4):
+def calculate_cost(prompt_tokens, output_tokens, exchange_rate=4):
     """
-    Oblicza przybliżony koszt wywołania API GPT-4:
+    Oblicza koszt wywołania API GPT-4:
       - 2.5 USD za milion tokenów dla prompta,
       - 10.0 USD za milion tokenów dla wygenerowanego tekstu.
     Zwraca koszt w USD oraz przeliczony na złote.
     """
-    prompt_tokens = approximate_token_count(prompt_text)
-    output_tokens = approximate_token_count(generated_text)
-    cost_prompt_usd = prompt_tokens * 2.5 / 1_000_000
-    cost_output_usd = output_tokens * 10.0 / 1_000_000
-    total_cost_usd = cost_prompt_usd + cost_output_usd
-    total_cost_pln = total_cost_usd * exchange_rate
-    return total_cost_usd, total_cost_pln
-
-
-def simulate_loading():
-    placeholder = st.empty()
-    messages = [
-        "Problem wysłany do mistrza pióra...",
-        "Mistrz Pióra główkuje...",
-        "Ok, to interesujące...",
-        "Hmm... niezłe...",
-        "Prawie gotowe...",
-        "Gotowe, mistrz wysłał priorytetem!",
-        "Będzie za kilka sekund!"
-    ]
-    accumulated = ""
-    for msg in messages:
-        accumulated += f"- {msg}\n"
-        placeholder.markdown(accumulated)
-        time.sleep(2)
-    return placeholder
+    total_cost_usd = (prompt_tokens * PROMPT_PRICE_USD_PER_MTOK
+                      + output_tokens * OUTPUT_PRICE_USD_PER_MTOK) / 1_000_000
+    return total_cost_usd, total_cost_usd * exchange_rate
 
 
 # -------------------------  INTERFEJS STREAMLIT  -------------------------
@@ -310,8 +623,14 @@ def simulate_loading():
 def main():
     st.title("Mistrz Pióra: Rozwiąże Twoje Problemy w Rozrywkowy Sposób")
 
+    # Jeden klient Qdrant dla całego przebiegu skryptu, przekazywany jawnie do funkcji pomocniczych
+    client = get_qdrant_client()
+
+    if (get_env().get("DEBUG") or "").lower() in ("1", "true"):
+        check_password_roundtrip()
+
     # Upewniamy się, że istnieje kolekcja 'users'
-    create_users_collection()
+    create_users_collection(client)
 
     # Inicjalizacja zmiennych sesyjnych
     if "logged_in" not in st.session_state:
@@ -319,6 +638,9 @@ def main():
     if "username" not in st.session_state:
         st.session_state["username"] = ""
 
+    # Błędy zapisów historii wysłanych w tle w poprzednich przebiegach
+    report_failed_writes()
+
     # Cztery zakładki: Logowanie/Rejestracja, Reset Hasła, Generowanie, Historia
     tab_auth, tab_reset, tab_generate, tab_saved = st.tabs([
         "Logowanie / Rejestracja", "Reset Hasła", "Generuj", "Zapisane Opowieści i Żarty"
@@ -327,29 +649,37 @@ def main():
     # -------------------------  Zakładka 1: Logowanie / Rejestracja  -------------------------
     with tab_auth:
         st.subheader("Zarejestruj się lub zaloguj")
+        # Wybór akcji zostaje poza formularzem, bo od niego zależy, czy pokazać pole e-mail
         auth_mode = st.radio("Wybierz akcję:", ["Zarejestruj", "Zaloguj"])
-        username = st.text_input("Nazwa użytkownika:", key="auth_username")
-        password = st.text_input("Hasło:", type="password", key="auth_password")
-        email = None
-        if auth_mode == "Zarejestruj":
-            email = st.text_input("Adres e‑mail:", key="auth_email")
-
-        if st.button("Dalej", key="auth_button"):
+        # Formularz: wpisywanie danych nie przeładowuje strony, dopiero kliknięcie "Dalej"
+        with st.form("auth_form"):
+            username = st.text_input("Nazwa użytkownika:", key="auth_username")
+            password = st.text_input("Hasło:", type="password", key="auth_password")
+            email = None
+            if auth_mode == "Zarejestruj":
+                email = st.text_input("Adres e‑mail:", key="auth_email")
+            submitted = st.form_submit_button("Dalej")
+
+        if submitted:
             if not username or not password or (auth_mode == "Zarejestruj" and not email):
                 st.error("Podaj wszystkie wymagane dane!")
             else:
                 if auth_mode == "Zarejestruj":
-                    success = register_user(username, password, email)
+                    success = register_user(client, username, password, email)
                     if success:
                         st.success("Rejestracja udana! Możesz się teraz zalogować.")
                     else:
                         st.warning("Użytkownik o tej nazwie już istnieje.")
+                elif st.session_state["logged_in"] and st.session_state["username"] == username:
+                    # Sesja jest już uwierzytelniona – nie weryfikujemy ponownie hasła
+                    st.info("Jesteś już zalogowany.")
                 else:
-                    if login_user(username, password):
+                    if login_user(client, username, password):
                         st.success("Zalogowano pomyślnie!")
+                        st.session_state["auth_token"] = secrets.token_urlsafe(32)
                         st.session_state["logged_in"] = True
                         st.session_state["username"] = username
-                        create_user_collection_if_not_exists(username)
+                        create_user_collection_if_not_exists(client, username)
                     else:
                         st.error("Błędna nazwa użytkownika lub hasło. Jeśli nie pamiętasz hasła, przejdź do zakładki Reset Hasła")
 
@@ -366,7 +696,7 @@ def main():
             elif new_password != confirm_password:
                 st.error("Nowe hasło i potwierdzenie nie są zgodne!")
             else:
-                if reset_password(reset_username, reset_email, new_password):
+                if reset_password(client, reset_username, reset_email, new_password):
                     st.success("Hasło zostało zresetowane. Możesz się teraz zalogować.")
                 else:
                     st.error("Reset hasła nie powiódł się. Sprawdź dane.")
@@ -378,41 +708,62 @@ def main():
             st.warning("Musisz się zalogować, aby korzystać z tej zakładki.")
         else:
             st.info(f"Zalogowano jako: {st.session_state['username']}")
-            problem_input = st.text_area("Wpisz problem lub cokolwiek, czego nie rozumiesz:")
+            # Tryb zostaje poza formularzem, bo od niego zależy, czy pokazać pole stylu
             mode = st.radio("Wybierz tryb:", ("Ulubione Universum", "Zabawnie"))
-            style_input = None
-            if mode == "Ulubione Universum":
-                style_input = st.text_input("Wpisz ulubionego pisarza, reżysera lub tytuł ulubionego filmu:")
-
-            if st.button("Generuj", key="generate_button"):
+            with st.form("gen_form"):
+                problem_input = st.text_area("Wpisz problem lub cokolwiek, czego nie rozumiesz:")
+                style_input = None
+                if mode == "Ulubione Universum":
+                    style_input = st.text_input("Wpisz ulubionego pisarza, reżysera lub tytuł ulubionego filmu:")
+                submitted = st.form_submit_button("Generuj")
+
+            if submitted:
                 if not problem_input:
                     st.error("Pole problem jest puste!")
                 else:
                     prompt = generate_prompt(problem_input, mode, style_input)
                     
-                    # Wyświetlenie komunikatów – będą się akumulować
-                    loading_placeholder = simulate_loading()
-
-                    generated_text = get_gpt4_response(prompt)
-
-                    # Po wygenerowaniu odpowiedzi usuwamy komunikaty
-                    loading_placeholder.empty()
-
-                    if generated_text:
+                    # Spinner tylko do otwarcia strumienia – dalej postęp widać po pojawiającym się tekście
+                    with st.spinner("Problem wysłany do mistrza pióra..."):
+                        try:
+                            stream = get_gpt4_response(get_openai_client(), prompt)
+                        except Exception as e:
+                            st.error(f"Błąd przy generowaniu odpowiedzi: {e}")
+                            stream = None
+
+                    generated_text = None
+                    if stream:
                         st.subheader("Oto Twoja unikalna opowieść:")
-                        st.write(generated_text)
-                        
-                        cost_usd, cost_pln = calculate_cost(prompt, generated_text)
+                        usage = {}
+                        # Tekst pojawia się na bieżąco, w miarę generowania; błąd w trakcie strumienia
+                        # (zerwane połączenie, limit) przerywa odpowiedź – wtedy nic nie zapisujemy
+                        try:
+                            generated_text = st.write_stream(stream_text(stream, usage)).strip()
+                        except Exception as e:
+                            st.error(f"Błąd przy generowaniu odpowiedzi: {e}")
+
+                    if generated_text is not None:
+                        if usage:
+                            prompt_tokens = usage["prompt_tokens"]
+                            output_tokens = usage["completion_tokens"]
+                        else:
+                            prompt_tokens = approximate_token_count(prompt)
+                            output_tokens = approximate_token_count(generated_text)
+                        cost_usd, cost_pln = calculate_cost(prompt_tokens, output_tokens)
                         st.markdown("---")
                         st.write(f"**Szacowany koszt to około  (~{cost_pln:.2f} zł)")
                         save_history(
+                            client,
                             account_name=st.session_state["username"],
                             record_type=mode,
                             prompt_text=prompt,
                             generated_text=generated_text,
+                            prompt_tokens=prompt_tokens,
+                            output_tokens=output_tokens,
                             cost_usd=cost_usd,
                             cost_pln=cost_pln
                         )
+                        st.success("Twoja opowieść została pomyślnie zapisana na Twoim koncie!")
 
     # -------------------------  Zakładka 4: Historia  -------------------------
     with tab_saved:
@@ -422,11 +773,17 @@ def main():
         else:
             st.info(f"Zalogowano jako: {st.session_state['username']}")
             user_collection = st.session_state["username"]
-            client = get_qdrant_client()
-            existing = client.get_collections().collections
-            collection_names = [col.name for col in existing]
-            if user_collection in collection_names:
-                history = get_history(user_collection)
+            if st.session_state.get("user_collection_ready") or collection_exists(client, user_collection):
+                # Historia jest uzupełniana lokalnie przez save_history i pobierana ponownie tylko wtedy,
+                # gdy od ostatniego pobrania do kolekcji trafił zapis (z tej lub innej sesji)
+                history_key = f"history_{user_collection}"
+                versions, lock = get_history_versions()
+                with lock:
+                    version = versions.get(user_collection, 0)
+                if st.session_state.get(history_key, {}).get("version") != version:
+                    points, next_start = get_history(client, user_collection)
+                    st.session_state[history_key] = {"points": points, "next_start": next_start, "version": version}
+                history = st.session_state[history_key]["points"]
                 if history:
                     for item in history:
                         payload = item.payload
@@ -436,10 +793,25 @@ def main():
                         cost_usd = payload.get("cost_usd", 0)
                         cost_pln = payload.get("cost_pln", 0)
                         st.write(f"**Szacowany koszt to około  (~{cost_pln:.2f} zł)")
+                    next_start = st.session_state[history_key]["next_start"]
+                    if next_start is not None and st.button("Załaduj więcej", key="history_more_button"):
+                        points, next_start = get_history(client, user_collection, start_from=next_start)
+                        seen_ids = {item.id for item in history}
+                        new_points = [item for item in points if item.id not in seen_ids]
+                        # Strona bez nowych rekordów (wszystkie z tym samym znacznikiem czasu) – dalej nie przejdziemy
+                        if not new_points:
+                            next_start = None
+                        st.session_state[history_key] = {
+                            "points": history + new_points, "next_start": next_start, "version": version
+                        }
+                        st.rerun()
                 else:
                     st.info("Brak zapisanych rekordów w Twojej kolekcji.")
             else:
                 st.warning("Twoja kolekcja jeszcze nie istnieje lub nie została poprawnie utworzona.")
 
+    # Bufor zapisów opróżniamy raz na przebieg, niezależnie od tego, które zakładki się wyrenderowały
+    flush_history(client)
+
 if __name__ == "__main__":
     main()